@@ -2,14 +2,20 @@
 
 from sklearn.gaussian_process.kernels import *
 from sklearn import neighbors
+from sklearn.metrics import pairwise_distances
 from scipy.sparse import issparse
-from scipy.spatial import distance_matrix, ConvexHull
+from scipy.sparse.csgraph import connected_components
+from scipy.linalg import cho_factor, cho_solve
+from scipy.spatial import ConvexHull
+from sklearn.base import clone
 
-from functools import reduce
-from collections import defaultdict
+from functools import lru_cache
+from collections import defaultdict, namedtuple
 from itertools import product
 
+import operator as op
 import warnings
+import ast
 
 import numpy as np
 import pandas as pd
@@ -39,36 +45,85 @@ _inter_hist_js_code="""
     // here is where original data is stored
     var x = orig.data['values'];
 
-    x = x.sort((a, b) => a - b);
     var n_bins = parseInt(bins.value); // can be either string or int
-    var bin_size = (x[x.length - 1] - x[0]) / n_bins;
+    // extent of the data is precomputed in Python, no need to sort or scan the values
+    var bin_size = (x_max - x_min) / n_bins;
+    var inv_bin_size = bin_size > 0 ? 1 / bin_size : 0;
+
+    var hist = new Array(n_bins);
+    var l_edges = new Array(n_bins);
+    var r_edges = new Array(n_bins);
+    for (var j = 0; j < n_bins; j++) {
+        hist[j] = 0;
+        l_edges[j] = x_min + bin_size * j;
+        r_edges[j] = x_min + bin_size * (j + 1);
+    }
 
-    var hist = new Array(n_bins).fill().map((_, i) => { return 0; });
-    var l_edges = new Array(n_bins).fill().map((_, i) => { return x[0] + bin_size * i; });
-    var r_edges = new Array(n_bins).fill().map((_, i) => { return x[0] + bin_size * (i + 1); });
-    var indices = new Array(n_bins).fill().map((_) => { return []; });
+    // create the histogram, the last bin is closed (just like in numpy)
+    var bin_ix = new Int32Array(x.length);
+    var sum = 0;
+    for (var i = 0; i < x.length; i++) {
+        if (isNaN(x[i])) {
+            // just like in numpy, NaNs are not counted
+            bin_ix[i] = -1;
+            continue;
+        }
+        var k = ((x[i] - x_min) * inv_bin_size) | 0;
+        if (k >= n_bins) {
+            k = n_bins - 1;
+        }
+        bin_ix[i] = k;
+        hist[k] += 1;
+        sum += 1;
+    }
 
-    // create the histogram
+    // indices of values in each bin, stored contiguously:
+    // bin j holds flat_indices[offsets[j]] ... flat_indices[offsets[j + 1] - 1]
+    var offsets = new Int32Array(n_bins + 1);
+    for (var j = 0; j < n_bins; j++) {
+        offsets[j + 1] = offsets[j] + hist[j];
+    }
+    var cursor = new Int32Array(offsets);
+    var flat_indices = new Int32Array(x.length);
     for (var i = 0; i < x.length; i++) {
-        for (var j = 0; j < r_edges.length; j++) {
-            if (x[i] <= r_edges[j]) {
-                hist[j] += 1;
-                indices[j].push(i);
-                break;
-            }
+        if (bin_ix[i] >= 0) {
+            flat_indices[cursor[bin_ix[i]]++] = i;
         }
     }
 
     // make it a density
-    var sum = hist.reduce((a, b) => a + b, 0);
-    var deltas = r_edges.map((c, i) => { return c - l_edges[i]; });
-    // just like in numpy
-    hist = hist.map((c, i) => { return c / deltas[i] / sum; });
+    for (var j = 0; j < n_bins; j++) {
+        hist[j] = hist[j] / (r_edges[j] - l_edges[j]) / sum;
+    }
 
     source.data['hist'] = hist;
     source.data['l_edges'] = l_edges;
     source.data['r_edges'] = r_edges;
-    source.data['indices'] = indices;
+    source.data['l_offsets'] = offsets.subarray(0, n_bins);
+    source.data['r_offsets'] = offsets.subarray(1);
+    orig.data['flat_indices'] = flat_indices;
+
+    source.change.emit();
+"""
+
+
+_inter_hist_bank_js_code="""
+    // histograms are precomputed for all possible number of bins
+    var n_bins = parseInt(bins.value); // can be either string or int
+
+    // the bins are equally wide, same as np.linspace(minn, maxx, n_bins + 1)
+    var step = (maxx - minn) / n_bins;
+    var l_edges = new Float64Array(n_bins);
+    var r_edges = new Float64Array(n_bins);
+    for (var i = 0; i < n_bins; i++) {
+        l_edges[i] = minn + i * step;
+        r_edges[i] = minn + (i + 1) * step;
+    }
+    r_edges[n_bins - 1] = maxx;
+
+    source.data['hist'] = banks.data['hist'][n_bins - 1];
+    source.data['l_edges'] = l_edges;
+    source.data['r_edges'] = r_edges;
 
     source.change.emit();
 """
@@ -76,14 +131,17 @@ _inter_hist_js_code="""
 
 def _inter_color_code(*colors):
     assert len(colors) > 0, 'Doesn\'t make sense using no colors.'
-    color_code = '\n'.join((f'renderers[i].glyph.{c} = {{field: cb_obj.value, transform: transform}};'
-                            for c in colors))
+    color_code = '\n'.join((f'glyph.{c} = spec;' for c in colors))
     return f"""
             var transform = cmaps[cb_obj.value]['transform'];
-            var low = Math.min.apply(Math, source.data[cb_obj.value]);
-            var high = Math.max.apply(Math, source.data[cb_obj.value]);
+            // precomputed in Python
+            var low = extents[cb_obj.value][0];
+            var high = extents[cb_obj.value][1];
+            // shared by all the renderers
+            var spec = {{field: cb_obj.value, transform: transform}};
 
             for (var i = 0; i < renderers.length; i++) {{
+                var glyph = renderers[i].glyph;
                 {color_code}
             }}
 
@@ -95,6 +153,161 @@ def _inter_color_code(*colors):
             """
 
 
+def _minmax(values, n_zeros=0, is_sorted=False):
+    if len(values) == 0:
+        return 0, 0
+
+    minn, maxx = (values[0], values[-1]) if is_sorted else (np.min(values), np.max(values))
+    if n_zeros > 0:
+        minn, maxx = min(minn, 0), max(maxx, 0)
+
+    return minn, maxx
+
+
+def _fast_hist(values, bins, n_zeros=0):
+    """
+    Helper function which computes a density histogram, same as `np.histogram(values, bins=bins, density=True)`,
+    except that NaNs are ignored.
+
+    Params
+    --------
+        values: np.array
+            1-D array of values
+        bins: int; str
+            number of equal-width bins or a binning strategy from `np.histogram_bin_edges`
+        n_zeros: int, optional (default: `0`)
+            number of additional zeros not present in `values`,
+            e.g. the implicit zeros of a sparse column
+
+    Returns
+    --------
+        hist: np.array
+            values of the histogram
+        edges: np.array
+            edges of the bins
+    """
+    values = values[~np.isnan(values)]
+    if n_zeros > 0 and (np.ndim(bins) > 0 or isinstance(bins, str)):
+        # the binning strategies need all the values
+        values, n_zeros = np.concatenate([values, np.zeros(n_zeros, dtype=values.dtype)]), 0
+
+    if np.ndim(bins) > 0:
+        # explicit (possibly non-uniform) bin edges
+        return np.histogram(values, bins=bins, density=True)
+
+    if isinstance(bins, str):
+        edges = np.histogram_bin_edges(values, bins=bins)
+    else:
+        minn, maxx = _minmax(values, n_zeros)
+        if minn == maxx:
+            # just like in numpy
+            minn, maxx = minn - 0.5, maxx + 0.5
+        edges = np.linspace(minn, maxx, bins + 1)
+
+    n_bins = len(edges) - 1
+    ixs = ((values - edges[0]) * (n_bins / (edges[-1] - edges[0]))).astype(np.int64)
+    np.clip(ixs, 0, n_bins - 1, out=ixs)
+    # the computed index can be off by one for values on the edges, correct it like numpy does
+    # the last bin is closed
+    ixs -= values < edges[ixs]
+    ixs += (values >= edges[ixs + 1]) & (ixs != n_bins - 1)
+    counts = np.bincount(ixs, minlength=n_bins)
+    if n_zeros > 0:
+        counts[min(np.searchsorted(edges, 0, side='right') - 1, n_bins - 1)] += n_zeros
+
+    return counts / counts.sum() / np.diff(edges), edges
+
+
+def _bin_indices(values, edges):
+    """
+    Helper function which groups the indices of values by the bin they fall into.
+
+    Params
+    --------
+        values: np.array
+            values to bin
+        edges: np.array
+            edges of the bins, as returned by `np.histogram`
+
+    Returns
+    --------
+        flat_indices: np.array
+            indices of the values, sorted by their bin; the indices of NaNs,
+            which don't belong to any bin, are at the end
+        offsets: np.array
+            indices of bin `i` are `flat_indices[offsets[i]:offsets[i + 1]]`
+    """
+    n_bins = len(edges) - 1
+    is_nan = np.isnan(values)
+    valid = np.flatnonzero(~is_nan)
+    bin_ix = np.clip(np.searchsorted(edges, values[valid], side='right') - 1, 0, n_bins - 1)
+    flat_indices = np.concatenate([valid[np.argsort(bin_ix, kind='stable')], np.flatnonzero(is_nan)]).astype(np.int32)
+    offsets = np.zeros(n_bins + 1, dtype=np.int32)
+    offsets[1:] = np.cumsum(np.bincount(bin_ix, minlength=n_bins))
+
+    return flat_indices, offsets
+
+
+def _hist_banks(values, max_bins, n_zeros=0):
+    """
+    Helper function which precomputes the density histograms for `1, ..., max_bins` bins.
+
+    Params
+    --------
+        values: np.array
+            1-D array of values
+        max_bins: int
+            maximum number of bins
+        n_zeros: int, optional (default: `0`)
+            number of additional zeros not present in `values`
+
+    Returns
+    --------
+        hists: list(np.array)
+            the `i`-th element is the histogram with `i + 1` bins
+        extent: tuple(float, float)
+            the first and last edge, the edges are `np.linspace(*extent, n_bins + 1)`
+    """
+    values = np.sort(values[~np.isnan(values)])
+    n_values = len(values) + n_zeros
+    minn, maxx = _minmax(values, n_zeros, is_sorted=True)
+    if minn == maxx:
+        # just like in numpy
+        minn, maxx = minn - 0.5, maxx + 0.5
+
+    hists = []
+    for n_bins in range(1, max_bins + 1):
+        edges = np.linspace(minn, maxx, n_bins + 1)
+        # the last bin is closed
+        ixs = np.searchsorted(values, edges, side='left') + n_zeros * (edges > 0)
+        ixs[-1] = n_values
+        hists.append(np.diff(ixs) / np.diff(edges) / n_values)
+
+    # the edges are cheap to recreate in JS, no need to send them
+    return hists, (float(minn), float(maxx))
+
+
+def _take_rows(X, rows):
+    # `rows` must be sorted and unique, a contiguous block is just a slice
+    # which for CSR matrices only needs the `indptr`, instead of going through fancy indexing
+    if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+        return X[rows[0]:rows[-1] + 1]
+
+    return X[rows]
+
+
+def _obs_as_str(adata, key):
+    # same as list(map(str, adata.obs[key])), but for categoricals only the categories are converted
+    values = adata.obs[key]
+    if values.dtype.name != 'category':
+        return values.astype(str).values
+
+    # missing values have code -1, i.e. the last element
+    categories = np.append(values.cat.categories.astype(str).values.astype(object), 'nan')
+
+    return categories[values.cat.codes.values]
+
+
 def _set_plot_wh(fig, w, h):
     if w is not None:
         fig.plot_width = w
@@ -102,7 +315,7 @@ def _set_plot_wh(fig, w, h):
         fig.plot_height = h
 
 
-def _create_mapper(adata, key):
+def _create_mapper(adata, key, cells=None):
     """
     Helper function to create CategoricalColorMapper from annotated data.
 
@@ -113,38 +326,207 @@ def _create_mapper(adata, key):
         key: str
             key in `adata.obs.obs_keys()` or `adata.var_names`, for which we want the colors; if no colors for given
             column are found in `adata.uns[key_colors]`, use `viridis` palette
+        cells: np.array, optional (default: `None`)
+            indices of cells from which the range of continuous values is computed,
+            if `None` or empty, use all cells
 
     Returns
     --------
         mapper: bokeh.models.mappers.CategoricalColorMapper
             mapper which maps valuems from `adata.obs[key]` to colors
     """
+    if cells is not None and len(cells) == 0:
+        # e.g. path without any nonzero counts, the range would be undefined
+        cells = None
+
     if not key in adata.obs_keys():
         assert key in adata.var_names,  f'`{key}` not found in `adata.obs_keys()` or `adata.var_names`'
         ix = np.where(adata.var_names == key)[0][0]
-        vals = list(adata.X[:, ix])
-        palette = cm.get_cmap('viridis', adata.n_obs)
+        vals = adata.X[:, ix]
+        if cells is not None:
+            vals = vals[cells]
+        # for sparse matrices, this only looks at the stored values (and whether there are any implicit zeros)
+        minn, maxx = (vals.min(), vals.max()) if issparse(vals) else (np.min(vals), np.max(vals))
 
-        mapper = dict(zip(vals, range(len(vals))))
-        palette = to_hex_palette(palette([mapper[v] for v in vals]))
+        # the mapper interpolates the values, no need for a color per cell
+        return LinearColorMapper(palette=viridis(256), low=float(minn), high=float(maxx))
+
+    is_categorical = adata.obs[key].dtype.name == 'category'
+    if not is_categorical:
+        palette = adata.uns.get(f'{key}_colors', None)
+        palette = viridis(256) if palette is None else to_hex_palette(palette)
+
+        vals = adata.obs[key].values if cells is None else adata.obs[key].values[cells]
 
         return LinearColorMapper(palette=palette, low=np.min(vals), high=np.max(vals))
 
-    is_categorical = adata.obs[key].dtype.name == 'category'
-    default_palette = cm.get_cmap('viridis', adata.n_obs if not is_categorical else len(adata.obs[key].unique()))
+    default_palette = cm.get_cmap('viridis', len(adata.obs[key].unique()))
     palette = adata.uns.get(f'{key}_colors', default_palette)
 
     if palette is default_palette:
-        vals = adata.obs[key].unique() if is_categorical else adata.obs[key]
+        vals = adata.obs[key].unique()
         mapper = dict(zip(vals, range(len(vals))))
         palette = palette([mapper[v] for v in vals])
 
     palette = to_hex_palette(palette)
 
-    if is_categorical:
-        return CategoricalColorMapper(palette=palette, factors=list(map(str, adata.obs[key].cat.categories)))
+    return CategoricalColorMapper(palette=palette, factors=list(map(str, adata.obs[key].cat.categories)))
+
+
+def _rbf_kernel(a, b, length_scale):
+    # computed in place, only the output matrix is allocated
+    res = np.subtract.outer(a, b)
+    res *= 1 / length_scale
+    np.square(res, out=res)
+    res *= -0.5
+    np.exp(res, out=res)
+
+    return res
+
+
+def _euclidean_dmat(x):
+    # ||x_i - x_j||^2 = ||x_i||^2 + ||x_j||^2 - 2 <x_i, x_j>, the inner products are a single GEMM
+    sq_norms = np.einsum('ij,ij->i', x, x)
+    res = x @ x.T
+    res *= -2
+    res += sq_norms[:, None]
+    res += sq_norms[None, :]
+    # the cancellation can make the result slightly negative
+    np.maximum(res, 0, out=res)
+    np.sqrt(res, out=res)
+    np.fill_diagonal(res, 0)
+
+    return res
+
+
+def _fast_gp_rbf(x, y, x_test, length_scale, alpha):
+    """
+    Helper function which fits and evaluates a Gaussian Process with fixed RBF kernel.
+    Equivalent to `GaussianProcessRegressor(kernel=RBF(length_scale), alpha=alpha, optimizer=None)`.
+
+    Params
+    --------
+        x: np.array
+            1-D array of features
+        y: np.array
+            1-D array of targets or 2-D array with one target per column,
+            all of them are fitted at once
+        x_test: np.array
+            1-D array of points for which we predict the values
+        length_scale: float
+            length scale of the RBF kernel
+        alpha: float; np.array
+            value added to the diagonal of the kernel matrix; if `y` is 2-D,
+            it can be also be an array containing the value for each target
+
+    Returns
+    --------
+        mean: np.array
+            mean of the response, same number of dimensions as `y`
+        std: np.array
+            standard deviation of the response, same number of dimensions as `y`
+    """
+    x, x_test = np.ravel(x), np.ravel(x_test)
+
+    K = _rbf_kernel(x, x, length_scale)
+    K_test = _rbf_kernel(x_test, x, length_scale)
+
+    if np.ndim(y) == 2 and np.ndim(alpha) == 1 and np.any(alpha != alpha[0]):
+        no_noise = alpha <= 0
+        if np.any(no_noise):
+            # the kernel matrix can be singular without noise, the Cholesky decomposition fails loudly (same as sklearn)
+            # whereas the eigendecomposition would silently divide by ~0
+            mean, std = np.empty((len(x_test), y.shape[1])), np.empty((len(x_test), y.shape[1]))
+            for mask in (no_noise, ~no_noise):
+                mean[:, mask], std[:, mask] = _fast_gp_rbf(x, y[:, mask], x_test, length_scale, alpha[mask])
+
+            return mean, std
+
+        # different noise for each target: (K + aI)^-1 = Q (diag(l) + aI)^-1 Q^T,
+        # so that the eigendecomposition is shared by all the targets
+        lam, Q = np.linalg.eigh(K)
+        inv = 1 / (np.clip(lam, 0, None)[:, None] + alpha[None, :])
+        B = K_test @ Q
+        mean = B @ ((Q.T @ y) * inv)
+        # the RBF kernel is 1 on the diagonal
+        var = 1 - (B ** 2) @ inv
+
+        return mean, np.sqrt(np.clip(var, 0, None))
+
+    K[np.diag_indices_from(K)] += alpha if np.ndim(y) == 1 else np.ravel(alpha)[0]
+    L = cho_factor(K, lower=True)
+
+    # one triangular solve for all the targets
+    mean = K_test @ cho_solve(L, y)
+    # only the diagonal of the covariance matrix, the RBF kernel is 1 on the diagonal
+    var = 1 - np.einsum('ij,ji->i', K_test, cho_solve(L, K_test.T))
+    std = np.sqrt(np.clip(var, 0, None))
+
+    return mean, std if np.ndim(y) == 1 else np.repeat(std[:, None], y.shape[1], axis=1)
+
+
+def _freeze(params):
+    # hashable version of (possibly nested) dictionary of parameters
+    return tuple(sorted((k, _freeze(v) if isinstance(v, dict) else v) for k, v in params.items()))
+
+
+@lru_cache(maxsize=128)
+def _parse_kernel(kernel_expr, kernel_params, kernel_default_params, default=False):
+    """
+    Helper function which creates a kernel from an expression.
+
+    Params
+    --------
+        kernel_expr: str
+            expression combining kernel variables, see `_smooth_expression`
+        kernel_params: dict; tuple
+            parameters of the kernel variables, either a dictionary or its `_freeze`-d version
+        kernel_default_params: dict; tuple
+            default parameters for a kernel, either a dictionary or its `_freeze`-d version
+        default: bool, optional (default: `False`)
+            whether to use default parameters for kernel variables not found in `kernel_params`
+
+    Returns
+    --------
+        kernel: sklearn.gaussian_process.kernels.Kernel
+            the parsed kernel, must not be modified since it's cached
+    """
+
+    def _eval(node):
+        if isinstance(node, ast.Num):
+            return node.n
+
+        if isinstance(node, ast.Name):
+            if not default and node.id not in kernel_params:
+                raise ValueError(f'Error while parsing `{kernel_expr}`: `{node.id}` is not a valid key in kernel_params. To use RBF kernel with default parameters, specify default=True.')
+            params = dict(kernel_params.get(node.id, kernel_default_params))
+            kernel_type = params.pop('type', 'rbf')
+            return kernels[kernel_type](**params)
+
+        if isinstance(node, ast.BinOp):
+            return operators[type(node.op)](_eval(node.left), _eval(node.right))
+
+        if isinstance(node, ast.UnaryOp):
+            return operators[type(node.op)](_eval(node.operand))
+
+        raise TypeError(node)
+
+    operators = {ast.Add : op.add,
+                 ast.Mult: op.mul,
+                 ast.Pow :op.pow}
+    kernels = dict(const=ConstantKernel,
+                   white=WhiteKernel,
+                   rbf=RBF,
+                   mat=Matern,
+                   rq=RationalQuadratic,
+                   esn=ExpSineSquared,
+                   dp=DotProduct,
+                   pw=PairwiseKernel)
+
+    kernel_params = {k: dict(v) for k, v in dict(kernel_params).items()}
+    kernel_default_params = dict(kernel_default_params)
 
-    return LinearColorMapper(palette=palette, low=np.min(adata.obs[key]), high=np.max(adata.obs[key]))
+    return _eval(ast.parse(kernel_expr, mode='eval').body)
 
 
 def _smooth_expression(x, y, n_points=100, time_span=[None, None], mode='gp', kernel_params=dict(), kernel_default_params=dict(),
@@ -156,7 +538,9 @@ def _smooth_expression(x, y, n_points=100, time_span=[None, None], mode='gp', ke
     x: list(number)
         list of features
     y: list(number)
-        list of targets
+        list of targets or a 2-D array with one target per column,
+        which are smoothed at once; for mode=`'gp'`, `alpha` in `opt_params` is then
+        either a scalar or an array with the value for each target
     n_points: int, optional (default: `100`)
         number of points to extrapolate
     time_span: list(int), optional (default `[None, None]`)
@@ -187,45 +571,12 @@ def _smooth_expression(x, y, n_points=100, time_span=[None, None], mode='gp', ke
         points for which we predict the values
     x_mean: np.array
         mean of the response
-    cov: np.array (`None` for mode=`'krr'`)
-        covariance matrix of the response
+    std: np.array (`None` for mode=`'krr'`)
+        standard deviation of the response
     """
 
     from sklearn.kernel_ridge import KernelRidge
     from sklearn.gaussian_process import GaussianProcessRegressor
-    import operator as op
-    import ast
-
-    def _eval(node):
-        if isinstance(node, ast.Num):
-            return node.n
-
-        if isinstance(node, ast.Name):
-            if not default and node.id not in kernel_params:
-                raise ValueError(f'Error while parsing `{kernel_expr}`: `{node.id}` is not a valid key in kernel_params. To use RBF kernel with default parameters, specify default=True.')
-            params = kernel_params.get(node.id, kernel_default_params)
-            kernel_type = params.pop('type', 'rbf')
-            return kernels[kernel_type](**params)
-
-        if isinstance(node, ast.BinOp):
-            return operators[type(node.op)](_eval(node.left), _eval(node.right))
-
-        if isinstance(node, ast.UnaryOp):
-            return operators[type(node.op)](_eval(node.operand))
-
-        raise TypeError(node)
-
-    operators = {ast.Add : op.add,
-                 ast.Mult: op.mul,
-                 ast.Pow :op.pow}
-    kernels = dict(const=ConstantKernel,
-                   white=WhiteKernel,
-                   rbf=RBF,
-                   mat=Matern,
-                   rq=RationalQuadratic,
-                   esn=ExpSineSquared,
-                   dp=DotProduct,
-                   pw=PairwiseKernel)
 
     minn, maxx = time_span
     x_test = np.linspace(np.min(x) if minn is None else minn, np.max(x) if maxx is None else maxx, n_points)[:, None]
@@ -240,36 +591,69 @@ def _smooth_expression(x, y, n_points=100, time_span=[None, None], mode='gp', ke
                 print(f'Smoothing using KRR with length_scale: {length_scale}.')
 
         kernel = opt_params.pop('kernel', 'rbf')
+        if kernel == 'rbf' and set(opt_params.keys()) <= {'alpha'}:
+            # fixed RBF kernel, no need to go through sklearn
+            x_train, length_scale = np.ravel(x), 1 / np.sqrt(2 * gamma)
+            K = _rbf_kernel(x_train, x_train, length_scale)
+            K[np.diag_indices_from(K)] += opt_params.get('alpha', 1)
+            dual_coef = cho_solve(cho_factor(K, lower=True), y)
+
+            return x_test, _rbf_kernel(np.ravel(x_test), x_train, length_scale) @ dual_coef, None
+
         model = KernelRidge(gamma=gamma, kernel=kernel, **opt_params)
         model.fit(x, y)
 
-        return x_test, model.predict(x_test), [None] * n_points
+        return x_test, model.predict(x_test), None
 
     if mode == 'gp':
-
         if kernel_expr is None:
             assert len(kernel_params) == 1
             kernel_expr, = kernel_params.keys()
 
-        kernel = _eval(ast.parse(kernel_expr, mode='eval').body)
+        try:
+            # parsing is cached, since this function is called for every gene and path
+            kernel = clone(_parse_kernel(kernel_expr, _freeze(kernel_params), _freeze(kernel_default_params), default))
+        except TypeError:
+            # unhashable parameters
+            kernel = _parse_kernel.__wrapped__(kernel_expr, kernel_params, kernel_default_params, default)
+
         alpha = opt_params.pop('alpha', None)
         if alpha is None:
-            alpha = np.std(y) 
+            alpha = np.std(y, axis=0)
 
         optimizer = opt_params.pop('optimizer', None)
+        if optimizer is None and not opt_params and type(kernel) is RBF and np.ndim(kernel.length_scale) == 0:
+            # fixed RBF kernel, no need to go through sklearn
+            mean, std = _fast_gp_rbf(x, y, x_test, kernel.length_scale, alpha)
+
+            return x_test, mean, std
+
         opt_params['kernel'] = kernel
 
-        model = GaussianProcessRegressor(alpha=alpha, optimizer=optimizer, **opt_params)
-        model.fit(x, y)
+        if np.ndim(y) == 1:
+            model = GaussianProcessRegressor(alpha=alpha, optimizer=optimizer, **opt_params)
+            model.fit(x, y)
+
+            mean, std = model.predict(x_test, return_std=True)
+
+            return x_test, mean, std
 
-        mean, cov = model.predict(x_test, return_cov=True)
+        # sklearn uses the same noise for all the targets, fit them one by one
+        alphas = alpha if np.ndim(alpha) == 1 else [alpha] * y.shape[1]
+        means, stds = zip(*(GaussianProcessRegressor(alpha=a, optimizer=optimizer, **opt_params).fit(x, y[:, i]).predict(x_test, return_std=True)
+                            for i, a in enumerate(alphas)))
 
-        return x_test, mean, cov
+        return x_test, np.stack(means, axis=1), np.stack(stds, axis=1)
 
     raise ValueError(f'Uknown type: `{type}`.')
 
 
-def _create_gt_fig(adatas, dataframe, color_key, title, color_mapper, show_cont_annot=False,
+# expression of a gene along a path
+# `cells` are the indices of the plotted cells, `x_test`, `x_mean` and `x_std` are `None` if it couldn't be smoothed
+_TrendPath = namedtuple('_TrendPath', ['label', 'cells', 'expr', 'dpt', 'color', 'x_test', 'x_mean', 'x_std'])
+
+
+def _create_gt_fig(adata, trends, color_key, title, color_mapper, show_cont_annot=False,
                    use_raw=True, genes=[], legend_loc='top_right',
                    plot_width=None, plot_height=None):
     """
@@ -278,14 +662,16 @@ def _create_gt_fig(adatas, dataframe, color_key, title, color_mapper, show_cont_
 
     Params:
     --------
-    dataframe: pandas.DataFrame
-        dataframe containing the velocity data
+    adata: AnnData
+        annotated data object
+    trends: list(_TrendPath)
+        expression along each path
     color_key: str
-        column in `dataframe` that is to be mapped to colors
+        key in `adata.obs_keys()` that is to be mapped to colors
     title: str
         title of the figure
     color_mapper: bokeh.models.mappers.CategoricalColorMapper
-        transformation which assings a value from `dataframe[color_key]` to a color
+        transformation which assings a value from `adata.obs[color_key]` to a color
     show_cont_annot: bool, optional (default: `False`)
         show continuous annotations in `adata.obs`, if `color_key` is
         itself a continuous variable
@@ -312,14 +698,15 @@ def _create_gt_fig(adatas, dataframe, color_key, title, color_mapper, show_cont_
     fig = figure(title=title)
     _set_plot_wh(fig, plot_width, plot_height)
 
+    is_categorical = color_key in adata.obs_keys() and adata.obs[color_key].dtype.name == 'category'
     renderers, color_selects = [], []
-    for i, (adata, marker, (path, df)) in enumerate(zip(adatas, markers, dataframe.iterrows())):
-        ds = {'dpt': df['dpt'],
-              'expr': df['expr'],
-              f'{color_key}': df[color_key]}
-        is_categorical = color_key in adata.obs_keys() and adata.obs[color_key].dtype.name == 'category'
+    for marker, trend in zip(markers, trends):
+        path = trend.label
+        ds = {'dpt': trend.dpt,
+              'expr': trend.expr,
+              f'{color_key}': trend.color}
         if not is_categorical:
-            ds, mappers = _get_mappers(adata, ds, genes, use_raw=use_raw)
+            ds, mappers = _get_mappers(adata, ds, genes, use_raw=use_raw, cells=trend.cells)
 
         source = ColumnDataSource(ds)
         renderers.append(fig.scatter('dpt', 'expr', source=source,
@@ -336,22 +723,20 @@ def _create_gt_fig(adatas, dataframe, color_key, title, color_mapper, show_cont_
         if not is_categorical and show_cont_annot:
             color_selects.append(_add_color_select(color_key, fig, [renderers[-1]], source, mappers, suffix=f' [{path}]'))
 
-        ds = dict(df[['x_test', 'x_mean', 'x_cov']])
-        if ds.get('x_test') is not None:
-            if ds.get('x_mean') is not None:
-                source = ColumnDataSource(ds)
-                fig.line('x_test', 'x_mean', source=source, muted_alpha=0, legend_label=path)
-                if all(map(lambda val: val is not None, ds.get('x_cov', [None]))):
-                    x_mean = ds['x_mean']
-                    x_cov = ds['x_cov']
-                    band_x = np.append(ds['x_test'][::-1], ds['x_test'])
-                    # black magic, known only to the most illustrious of wizards
-                    band_y = np.append((x_mean - np.sqrt(np.diag(x_cov)))[::-1], (x_mean + np.sqrt(np.diag(x_cov))))
-                    fig.patch(band_x, band_y, alpha=0.1, line_color='black', fill_color='black',
-                              legend_label=path, line_dash='dotdash', muted_alpha=0)
-
-            if ds.get('x_grad') is not None:
-                fig.line('x_test', 'x_grad', source=source, muted_alpha=0)
+        if trend.x_test is not None and trend.x_mean is not None:
+            x_test, x_mean = np.ravel(trend.x_test), np.ravel(trend.x_mean)
+            source = ColumnDataSource({'x_test': x_test, 'x_mean': x_mean})
+            fig.line('x_test', 'x_mean', source=source, muted_alpha=0, legend_label=path)
+            if trend.x_std is not None:
+                x_std = np.ravel(trend.x_std)
+                n = len(x_test)
+                # black magic, known only to the most illustrious of wizards
+                band_x, band_y = np.empty(2 * n), np.empty(2 * n)
+                band_x[:n], band_x[n:] = x_test[::-1], x_test
+                np.subtract(x_mean[::-1], x_std[::-1], out=band_y[:n])
+                np.add(x_mean, x_std, out=band_y[n:])
+                fig.patch(band_x, band_y, alpha=0.1, line_color='black', fill_color='black',
+                          legend_label=path, line_dash='dotdash', muted_alpha=0)
 
     fig.legend.click_policy = 'mute'
 
@@ -420,19 +805,34 @@ def interactive_hist(adata, keys=['n_counts', 'n_genes'],
             raise ValueError(f'The key `{key}` does not exist in `adata.obs`, `adata.var` or `adata.var_names`.')
 
     def _create_adata_groups():
-        if groups is None:
-            return [adata], [('all',)]
-
-        combs = list(product(*[set(adata.obs[g]) for g in groups]))
-        adatas= [adata[reduce(lambda l, r: l & r,
-                              (adata.obs[k] == v for k, v in zip(groups, vals)), True)]
-                 for vals in combs] + [adata]
+        # the groups are represented by the indices of their cells, subsetting the AnnData would copy `.X`
+        if not groups:
+            return [np.arange(adata.n_obs)], [('all',)]
+
+        cats = [adata.obs[g].astype('category').cat for g in groups]
+        codes = np.stack([c.codes.values for c in cats])
+        shape = tuple(len(c.categories) for c in cats)
+
+        # each cell gets a code of its combination of values, cells with missing values are left out
+        valid = np.flatnonzero(np.all(codes >= 0, axis=0))
+        comb_codes = np.ravel_multi_index(codes[:, valid], shape)
+        order = np.argsort(comb_codes, kind='stable')
+        bounds = np.searchsorted(comb_codes[order], np.arange(np.prod(shape) + 1))
+
+        combs, cells = [], []
+        for i, vals in enumerate(product(*[c.categories for c in cats])):
+            if bounds[i] == bounds[i + 1]:
+                # empty group
+                continue
+            combs.append(vals)
+            # the sort is stable, so the indices are still in ascending order
+            cells.append(valid[order[bounds[i]:bounds[i + 1]]])
 
         if display_all:
             combs += [('all',)]
-            adatas += [adata]
+            cells += [np.arange(adata.n_obs)]
 
-        return adatas, combs
+        return cells, combs
 
     # group_v_combs contains the value combinations
     ad_gs = _create_adata_groups()
@@ -444,30 +844,46 @@ def interactive_hist(adata, keys=['n_counts', 'n_genes'],
         slider = Slider(start=1, end=max_bins, value=0, step=1,
                         title='Bins')
 
-        plots = []
-        for j, (ad, group_vs) in enumerate(filter(lambda ad_g: ad_g[0].n_obs > 0, zip(*ad_gs))):
-
-            if key in ad.obs.keys():
-                orig = ad.obs[key]
-                hist, edges = np.histogram(orig, density=True, bins=bins)
-            elif key in ad.var.keys():
-                orig = ad.var[key]
-                hist, edges = np.histogram(orig, density=True, bins=bins)
+        if key in adata.obs.keys():
+            values = adata.obs[key].values
+        elif key in adata.var.keys():
+            values = None
+        else:
+            # only the column of the gene, the groups then take their cells from it
+            values = adata.X[:, np.where(adata.var_names == key)[0][0]]
+
+        hists = []
+        for cells, group_vs in filter(lambda ad_g: len(ad_g[0]) > 0, zip(*ad_gs)):
+
+            if values is None:
+                orig = adata.var[key]
             else:
-                orig = ad[:, key].X
-                hist, edges = np.histogram(orig, density=True, bins=bins)
+                orig = values[cells]
+
+            n_zeros = 0
+            if issparse(orig):
+                # only work with the explicitly stored values
+                n_zeros = orig.shape[0] - orig.nnz
+                orig = orig.data
+            orig = np.ravel(orig)
+            hist, edges = _fast_hist(orig, bins, n_zeros=n_zeros)
 
             slider.value = len(hist)
             # case when automatic bins
             max_bins = max(max_bins, slider.value)
 
-            # original data, used for recalculation of histogram in JS code
-            orig = ColumnDataSource(data=dict(values=orig))
+            hists.append((group_vs, orig, n_zeros, hist, edges))
+
+        plots = []
+        for j, (group_vs, orig, n_zeros, hist, edges) in enumerate(hists):
+            # histograms for every possible number of bins, the slider only selects one
+            bank_hists, (minn, maxx) = _hist_banks(orig, max_bins, n_zeros=n_zeros)
+            banks = ColumnDataSource(data=dict(hist=bank_hists))
             # data that we update in JS code
             source = ColumnDataSource(data=dict(hist=hist, l_edges=edges[:-1], r_edges=edges[1:]))
 
             legend = ', '.join(': '.join(map(str, gv)) for gv in zip(groups, group_vs)) \
-                    if groups is not None else 'all'
+                    if groups else 'all'
             p = fig.quad(source=source, top='hist', bottom=0,
                          left='l_edges', right='r_edges',
                          fill_color=palette[j], legend_label=legend if legend_loc is not None else None,
@@ -475,7 +891,7 @@ def interactive_hist(adata, keys=['n_counts', 'n_genes'],
                          line_color="#555555", fill_alpha=fill_alpha)
 
             # create callback and slider
-            callback = CustomJS(args=dict(source=source, orig=orig), code=_inter_hist_js_code)
+            callback = CustomJS(args=dict(source=source, banks=banks, minn=minn, maxx=maxx), code=_inter_hist_bank_js_code)
             callback.args['bins'] = slider
             callbacks.append(callback)
 
@@ -512,7 +928,7 @@ def interactive_hist(adata, keys=['n_counts', 'n_genes'],
         from bokeh.layouts import grid
         plot = grid(children=cols, ncols=2)
     else:
-        cols = list(map(list, np.array_split(cols, np.ceil(len(cols) / 2))))
+        cols = [cols[i:i + 2] for i in range(0, len(cols), 2)]
         plot = layout(children=cols, sizing_mode='fixed', ncols=2)
 
     if save is not None:
@@ -577,19 +993,23 @@ def thresholding_hist(adata, key, categories, basis=['umap'], components=[1, 2],
 
     hist_fig.xaxis.axis_label = key
     hist_fig.yaxis.axis_label = 'normalized frequency'
-    hist, edges = np.histogram(adata.obs[key], density=True, bins=bins)
-    
+    hist, edges = _fast_hist(np.asarray(adata.obs[key]), bins)
+    flat_indices, offsets = _bin_indices(np.asarray(adata.obs[key]), edges)
+
     source = ColumnDataSource(data=dict(hist=hist, l_edges=edges[:-1], r_edges=edges[1:],
-                              category=['default'] * len(hist), indices=[[]] * len(hist)))
+                              category=['default'] * len(hist), l_offsets=offsets[:-1], r_offsets=offsets[1:]))
 
-    df = pd.concat([pd.DataFrame(adata.obsm[f'X_{bs}'][:, comp - (bs != 'diffmap')], columns=[f'x_{bs}', f'y_{bs}'])
-                    for bs, comp in zip(basis, components)], axis=1)
+    coords = np.empty((adata.n_obs, 2 * len(basis)), dtype=np.float32)
+    for i, (bs, comp) in enumerate(zip(basis, components)):
+        coords[:, 2 * i:2 * i + 2] = adata.obsm[f'X_{bs}'][:, comp - (bs != 'diffmap')]
+    df = pd.DataFrame(coords, columns=[f'{c}_{bs}' for bs in basis for c in ('x', 'y')], copy=False)
     df['values'] = list(adata.obs[key])
     df['category'] = 'default'
     df['visible_category'] = 'default'
     df['cat_stack'] = [['default']] * len(df)
+    df['flat_indices'] = flat_indices
 
-    orig = ColumnDataSource(df)
+    orig = ColumnDataSource({c: df[c].values for c in df.columns})
     color = dict(field='category', transform=CategoricalColorMapper(palette=palette, factors=list(categories.keys())))
     hist_fig.quad(source=source, top='hist', bottom=0,
                   left='l_edges', right='r_edges', color=color,
@@ -630,9 +1050,8 @@ def thresholding_hist(adata, key, categories, basis=['umap'], components=[1, 2],
         code_thresh.append(f'''
             if (source.data['l_edges'][i] + mid_{cat} >= min_{cat} && source.data['r_edges'][i] - mid_{cat} <= max_{cat}) {{
                 source.data['category'][i] = '{cat}';
-                for (var j = 0; j < source.data['indices'][i].length; j++) {{
-                    var ix = source.data['indices'][i][j];
-                    orig.data['category'][ix] = '{cat}';
+                for (var j = l_offsets[i]; j < r_offsets[i]; j++) {{
+                    orig.data['category'][flat_indices[j]] = '{cat}';
                 }}
             }}
         ''')
@@ -647,14 +1066,16 @@ def thresholding_hist(adata, key, categories, basis=['umap'], components=[1, 2],
     '''
         {
             source.data['category'][i] = 'default';
-            for (var j = 0; j < source.data['indices'][i].length; j++) {
-                var ix = source.data['indices'][i][j];
-                orig.data['category'][ix] = 'default';
+            for (var j = l_offsets[i]; j < r_offsets[i]; j++) {
+                orig.data['category'][flat_indices[j]] = 'default';
             }
         }
     ''')
     callback = CustomJS(args=args, code=f'''
         {';'.join(code_start)}
+        var flat_indices = orig.data['flat_indices'];
+        var l_offsets = source.data['l_offsets'];
+        var r_offsets = source.data['r_offsets'];
         for (var i = 0; i < source.data['hist'].length; i++) {{
             {';'.join(code_mid)}
             {' else '.join(code_thresh)}
@@ -667,7 +1088,13 @@ def thresholding_hist(adata, key, categories, basis=['umap'], components=[1, 2],
         input.js_on_change('value', callback)
 
     slider = Slider(start=1, end=100, value=len(hist), title='Bins')
-    interactive_hist_cb = CustomJS(args={'source': source, 'orig': orig, 'bins': slider}, code=_inter_hist_js_code)
+    x_min, x_max = np.nanmin(df['values']), np.nanmax(df['values'])
+    if x_min == x_max:
+        # just like in numpy
+        x_min, x_max = x_min - 0.5, x_max + 0.5
+    interactive_hist_cb = CustomJS(args={'source': source, 'orig': orig, 'bins': slider,
+                                         'x_min': float(x_min), 'x_max': float(x_max)},
+                                   code=_inter_hist_js_code)
     slider.js_on_change('value', interactive_hist_cb, callback)
 
     plot = column(row(hist_fig, column(slider, *inputs)), *emb_figs)
@@ -749,9 +1176,10 @@ def gene_trend(adata, paths, genes=None, mode='gp', exp_key='X',
     if mode == 'krr':
         warnings.warn('KRR is experimental; please consider using mode=`gp`')
 
+    path_cats = adata.obs[path_key].cat.categories
     for path in paths:
         for p in path:
-            assert p in adata.obs[path_key].cat.categories, f'`{p}` is not in `adata.obs[path_key]`. Possible values are: `{list(adata.obs[path_key].cat.categories)}`.'
+            assert p in path_cats, f'`{p}` is not in `adata.obs[path_key]`. Possible values are: `{list(path_cats)}`.'
 
     # check the input
     if 'dpt_pseudotime' not in adata.obs.keys():
@@ -759,92 +1187,100 @@ def gene_trend(adata, paths, genes=None, mode='gp', exp_key='X',
 
     # check the genes list
     if genes is None:
-        genes = adata[:, adata.var['velocity_genes']].var_names[:n_velocity_genes]
+        genes = adata.var_names[adata.var['velocity_genes'].values][:n_velocity_genes]
+
+    # expression is taken directly from the matrix, never from the slices of `adata`
+    if exp_key != 'X':
+        X, var_names = adata.layers[exp_key], adata.var_names
+    else:
+        X, var_names = (adata.raw.X, adata.raw.var_names) if use_raw else (adata.X, adata.var_names)
 
-    genes_indicator = np.in1d(genes, adata.var_names) #[gene in adata.var_names for gene in genes]
+    genes_indicator = np.in1d(genes, var_names) #[gene in var_names for gene in genes]
     if not all(genes_indicator):
         genes_missing = np.array(genes)[np.invert(genes_indicator)]
         print(f'Could not find the following genes: `{genes_missing}`.')
         genes = list(np.array(genes)[genes_indicator])
 
     mapper = _create_mapper(adata, color_key)
-    figs, adatas = [], []
-
-    for gene in genes:
-        data = defaultdict(list)
-        row_figs = []
-        y_lim_min, y_lim_max = np.inf, -np.inf
-        for path in paths:
-            path_ix = np.in1d(adata.obs[path_key], path)
-            ad = adata[path_ix].copy()
-
-            minn, maxx = time_span
-            ad.obs['dpt_pseudotime'] = ad.obs['dpt_pseudotime'].replace(np.inf, 1)
-            minn = np.min(ad.obs['dpt_pseudotime']) if minn is None else minn
-            maxx = np.max(ad.obs['dpt_pseudotime']) if maxx is None else maxx
-
-            # wish I could get rid of this copy
-            ad = ad[(ad.obs['dpt_pseudotime'] >= minn) & (ad.obs['dpt_pseudotime'] <= maxx)]
 
-            gene_exp = ad[:, gene].layers[exp_key] if exp_key != 'X' else (ad.raw if use_raw else ad)[:, gene].X
-
-            # exclude dropouts
-            ix = (gene_exp > 0).squeeze()
-            indexer = slice(None) if show_zero_counts else ix
-            # just use for sanity check with asserts
-            rev_indexer = ix if show_zero_counts else slice(None)
-
-            dpt = ad.obs['dpt_pseudotime']
-
-            if issparse(gene_exp):
-                gene_exp = gene_exp.A
-
-            gene_exp = np.squeeze(gene_exp[indexer, None])
-            data['expr'].append(gene_exp)
-            y_lim_min, y_lim_max = min(y_lim_min, np.min(gene_exp)), max(y_lim_max, np.max(gene_exp))
+    # indices of cells in each path whose pseudotime is within the time span
+    dpt = adata.obs['dpt_pseudotime'].replace(np.inf, 1).values
+    path_codes = adata.obs[path_key].cat.codes.values
+    # cells of each category, computed only once even if it's used in multiple paths
+    cat_indices = {p: np.flatnonzero(path_codes == path_cats.get_loc(p)) for p in set(p for path in paths for p in path)}
+    path_indices = []
+    for path in paths:
+        path_ix = np.unique(np.concatenate([cat_indices[p] for p in path]))
+        minn, maxx = time_span
+        minn = np.min(dpt[path_ix]) if minn is None else minn
+        maxx = np.max(dpt[path_ix]) if maxx is None else maxx
+        path_indices.append(path_ix[(dpt[path_ix] >= minn) & (dpt[path_ix] <= maxx)])
+
+    colors = adata.obs[color_key].values
+    # only keep the genes we need, row-oriented since the cells of each path are extracted at once
+    X = X[:, var_names.get_indexer(genes)]
+    if issparse(X) and X.format != 'csr':
+        X = X.tocsr()
+
+    # trends[i][j] is the trend of i-th gene along j-th path
+    # the outer loop goes over the paths, since everything computed for the path is shared by the genes
+    trends = [[None] * len(paths) for _ in genes]
+    for j, path_ix in enumerate(path_indices):
+        path_dpt, path_colors = dpt[path_ix], colors[path_ix]
+        path_X = _take_rows(X, path_ix)
+        # single precision is enough for plotting, the smoothing is done in double precision anyway
+        path_X = (path_X.A if issparse(path_X) else np.asarray(path_X)).astype(np.float32, copy=False)
+
+        # exclude dropouts
+        masks = path_X > 0
+
+        # (x_test, x_mean, x_std) for each gene
+        smoothed = [(None, None, None)] * len(genes)
+        # genes with the same dropouts have the same training points, they're smoothed at once
+        _, groups = np.unique(np.packbits(masks, axis=0).T, axis=0, return_inverse=True)
+        groups = np.ravel(groups)
+        for group in range(np.max(groups, initial=-1) + 1):
+            gene_ixs = np.flatnonzero(groups == group)
+            ix = masks[:, gene_ixs[0]]
+            if not np.any(ix):
+                continue
 
             # compute smoothed values from expression
-            data['dpt'].append(np.squeeze(dpt[indexer, None]))
-            data[color_key].append(np.array(ad[indexer].obs[color_key]))
-
-            assert all(gene_exp[rev_indexer] > 0)
-
-            if len(gene_exp[rev_indexer]) == 0:
+            x_test, x_mean, x_std = _smooth_expression(np.expand_dims(path_dpt[ix], -1), path_X[np.ix_(ix, gene_ixs)], mode=mode,
+                                                       time_span=time_span, n_points=n_points, kernel_params=dict(k=dict(length_scale=length_scale)),
+                                                       **kwargs)
+            for k, i in enumerate(gene_ixs):
+                smoothed[i] = (x_test, x_mean[:, k], None if x_std is None else x_std[:, k])
+
+        label = ', '.join(map(str, paths[j]))
+        for i, gene in enumerate(genes):
+            ix = masks[:, i]
+            if not np.any(ix):
                 print(f'All counts are 0 for: `{gene}`.')
-                continue
 
-            x_test, exp_mean, exp_cov = _smooth_expression(np.expand_dims(dpt[ix], -1), gene_exp[ix if show_zero_counts else slice(None)], mode=mode,
-                                                           time_span=time_span, n_points=n_points, kernel_params=dict(k=dict(length_scale=length_scale)),
-                                                           **kwargs)
-                                                      
-            data['x_test'].append(x_test)
-            data['x_mean'].append(exp_mean)
-            data['x_cov'].append(exp_cov)
-
-            # we need this for the _create mapper
-            adatas.append(ad[indexer])
-            
-            if separate_paths:
-                dataframe = pd.DataFrame(data, index=list(map(lambda path: ', '.join(map(str, path)), [path])))
-                row_figs.append(_create_gt_fig(adatas, dataframe, color_key, title=gene, color_mapper=mapper,
-                                               show_cont_annot=show_cont_annot, legend_loc=legend_loc, genes=extra_genes,
-                                               use_raw=use_raw, plot_width=plot_width, plot_height=plot_height))
-                adatas = []
-                data = defaultdict(list)
+            indexer = slice(None) if show_zero_counts else ix
+            trends[i][j] = _TrendPath(label, path_ix[indexer], path_X[indexer, i], path_dpt[indexer], path_colors[indexer], *smoothed[i])
 
+    def _create_fig(gene, trends):
+        return _create_gt_fig(adata, trends, color_key, title=gene, color_mapper=mapper,
+                              show_cont_annot=show_cont_annot, legend_loc=legend_loc, genes=extra_genes,
+                              use_raw=use_raw, plot_width=plot_width, plot_height=plot_height)
+
+    figs = []
+    for gene, gene_trends in zip(genes, trends):
         if separate_paths:
+            row_figs = [_create_fig(gene, [trend]) for trend in gene_trends]
             if share_y:
+                exprs = [t.expr for t in gene_trends if len(t.expr)]
+                y_lim_min = min(map(np.min, exprs), default=0)
+                y_lim_max = max(map(np.max, exprs), default=0)
                 # first child is the figure
                 for fig in map(lambda c: c.children[0], row_figs):
                     fig.y_range = Range1d(y_lim_min - 0.1, y_lim_max + 0.1)
 
             figs.append(row(row_figs))
-            row_figs = []
         else:
-            dataframe = pd.DataFrame(data, index=list(map(lambda path: ', '.join(map(str, path)), paths)))
-            figs.append(_create_gt_fig(adatas, dataframe, color_key, title=gene, color_mapper=mapper,
-                                       show_cont_annot=show_cont_annot, legend_loc=legend_loc, genes=extra_genes,
-                                       use_raw=use_raw, plot_width=plot_width, plot_height=plot_height))
+            figs.append(_create_fig(gene, gene_trends))
 
     plot = column(*figs)
 
@@ -928,13 +1364,33 @@ def highlight_de(adata, basis='umap', components=[1, 2], n_top_genes=10,
 
     df = pd.DataFrame(adata.obsm[f'X_{basis}'][:, components - (basis != 'diffmap')], columns=['x', 'y'])
     for k in cell_keys:
-        df[k] = list(map(str, adata.obs[k]))
-
-    knn = neighbors.KNeighborsClassifier(n_neighbors)
-    knn.fit(df[['x', 'y']], adata.obs[key])
-    df['prediction'] = knn.predict(df[['x', 'y']])
-
-    conv_hulls = df[df[key] == df['prediction']].groupby(key).apply(lambda df: df.iloc[ConvexHull(np.vstack([df['x'], df['y']]).T).vertices])
+        df[k] = _obs_as_str(adata, k)
+
+    # majority vote of the neighbors, same as KNeighborsClassifier(n_neighbors).predict on the training points,
+    # but with a single tree query
+    xy = np.ascontiguousarray(df[['x', 'y']].values, dtype=np.float64)
+    nn_ix = neighbors.KDTree(xy).query(xy, k=n_neighbors, return_distance=False)
+    labels = adata.obs[key].cat.codes.values
+    n_labels = len(adata.obs[key].cat.categories)
+    votes = np.bincount((np.arange(len(xy))[:, None] * n_labels + labels[nn_ix]).ravel(),
+                        minlength=len(xy) * n_labels).reshape(len(xy), n_labels)
+    # sklearn breaks the ties by the sorted labels, not by the order of the categories
+    label_order = np.argsort(np.asarray(adata.obs[key].cat.categories), kind='stable')
+    df['prediction'] = adata.obs[key].cat.categories.astype(str).values[label_order[np.argmax(votes[:, label_order], axis=1)]]
+
+    # cells which agree with the prediction, sorted by the group, so that each group is a contiguous block
+    agree = df[key].values == df['prediction'].values
+    labels = df[key].values[agree]
+    order = np.argsort(labels, kind='stable')
+    xy = np.ascontiguousarray(df[['x', 'y']].values[agree][order])
+    # group -> (xs, ys) of the hull vertices
+    conv_hulls = {}
+    for group, start, count in zip(*np.unique(labels[order], return_index=True, return_counts=True)):
+        if count < 3:
+            # not enough points for a hull
+            continue
+        vertices = xy[start + ConvexHull(xy[start:start + count]).vertices]
+        conv_hulls[group] = (vertices[:, 0], vertices[:, 1])
 
     mapper = _create_mapper(adata, key)
     categories = adata.obs[key].cat.categories
@@ -942,41 +1398,44 @@ def highlight_de(adata, basis='umap', components=[1, 2], n_top_genes=10,
     _set_plot_wh(fig, plot_width, plot_height)
     legend_dict = defaultdict(list)
 
+    # positions of the cells of each category, instead of comparing the whole column for each category
+    cat_indices = df.groupby(key, sort=False).indices
     for k in categories:
-        d = df[df[key] == k]
+        d = df.take(cat_indices.get(k, []))
         data_source =  ColumnDataSource(d)
         legend_dict[k].append(fig.scatter('x', 'y', source=data_source, color={'field': key, 'transform': mapper}, size=5, muted_alpha=0))
 
     hover_cell = HoverTool(renderers=[r[0] for r in legend_dict.values()], tooltips=[(f'{key}', f'@{key}')] + [(f'{k}', f'@{k}') for k in cell_keys[1:]])
 
-    c_hulls = conv_hulls.copy()
-    de_possible = conv_hulls[key].isin(adata.uns['rank_genes_groups']['names'].dtype.names)
+    # top ranked genes of each group, shape `(n_groups, n_top_genes)`
+    de_groups = adata.uns['rank_genes_groups']['names'].dtype.names
+    de_group_ix = {g: i for i, g in enumerate(de_groups)}
+    top_ranks = {k: np.stack([adata.uns['rank_genes_groups'][k][g][:n_top_genes] for g in de_groups])
+                 for k in de_keys}
+
     ok_patches = []
-    prev_cat = []
-    for i, isin in enumerate((~de_possible, de_possible)):
-        conv_hulls = c_hulls[isin]
+    for i, is_de in enumerate((False, True)):
+        groups = [g for g in conv_hulls.keys() if (g in de_group_ix) == is_de]
 
-        if len(conv_hulls) == 0:
+        if len(groups) == 0:
             continue
 
-        # must use 'group' instead of key since key is MultiIndex
-        conv_hulls.rename(columns={'leiden': 'group'}, inplace=True)
-        xs, ys, ks = zip(*conv_hulls.groupby('group').apply(lambda df: list(map(list, (df['x'], df['y'], df['group'])))))
         tmp_data = defaultdict(list)
-        tmp_data['xs'] = xs
-        tmp_data['ys'] = ys
-        tmp_data[key] = list(map(lambda k: k[0], ks))
+        tmp_data['xs'] = [list(conv_hulls[g][0]) for g in groups]
+        tmp_data['ys'] = [list(conv_hulls[g][1]) for g in groups]
+        tmp_data[key] = groups
         
         if i == 1:
-            ix = list(map(lambda k: adata.uns['rank_genes_groups']['names'].dtype.names.index(k), tmp_data[key]))
+            ix = [de_group_ix[k] for k in tmp_data[key]]
             for k in de_keys:
-                tmp = np.array(list(zip(*adata.uns['rank_genes_groups'][k])))[ix, :n_top_genes]
+                tmp = top_ranks[k][ix]
                 for j in range(n_top_genes):
                     tmp_data[f'{k}_{j}'] = tmp[:, j]
 
         tmp_data = pd.DataFrame(tmp_data)
+        tmp_indices = tmp_data.groupby(key, sort=False).indices
         for k in categories:
-            d = tmp_data[tmp_data[key] == k]
+            d = tmp_data.take(tmp_indices.get(k, []))
             source = ColumnDataSource(d)
 
             patches = fig.patches('xs', 'ys', source=source, fill_alpha=fill_alpha, muted_alpha=0, hover_alpha=0.5,
@@ -1100,37 +1559,78 @@ def link_plot(adata, key, genes=None, basis=['umap', 'pca'], components=[1, 2],
         assert highlight_only in adata.obs_keys(), f'`{highlight_only}` is not in adata.obs_keys().'
 
     genes = adata.var_names if genes is None else genes 
-    gene_subset = np.in1d(adata.var_names, genes)
+    # integer indexing is much faster than boolean mask, especially for sparse matrices
+    gene_subset = adata.var_names.get_indexer(list(genes))
+    gene_subset = np.unique(gene_subset[gene_subset >= 0])
 
     if distance != 'dpt':
-        d = adata.X[:, gene_subset]
-        if issparse(d):
-            d = d.A
-        dmat = distance_matrix(d, d, p=distance)
+        if issparse(adata.X):
+            d = adata.X.tocsc()[:, gene_subset].A
+        else:
+            d = adata.X[:, gene_subset]
+        if distance == 2:
+            # single precision GEMM
+            dmat = _euclidean_dmat(np.ascontiguousarray(d, dtype=np.float32))
+        elif distance == 1:
+            dmat = pairwise_distances(d, metric='manhattan', n_jobs=-1)
+        elif np.isinf(distance):
+            dmat = pairwise_distances(d, metric='chebyshev', n_jobs=-1)
+        else:
+            dmat = pairwise_distances(d, metric='minkowski', p=distance, n_jobs=-1)
     else:
-        if not all(gene_subset):
+        if len(gene_subset) != adata.n_vars:
             warnings.warn('`genes` is not None, are you sure this is what you want when using `dpt` distance?')
 
-        dmat = []
         ad_tmp = adata.copy()
         ad_tmp = ad_tmp[:, gene_subset]
-        for i in range(ad_tmp.n_obs):
-            ad_tmp.uns['iroot'] = i
-            sc.tl.dpt(ad_tmp)
-            dmat.append(list(ad_tmp.obs['dpt_pseudotime'].replace([np.nan, np.inf], [0, 1])))
-
-    dmat = pd.DataFrame(dmat, columns=list(map(str, range(adata.n_obs))))
-    df = pd.concat([pd.DataFrame(adata.obsm[f'X_{bs}'][:, comp - (bs != 'diffmap')], columns=[f'x{i}', f'y{i}'])
-                    for i, (bs, comp) in enumerate(zip(basis, components))] + [dmat], axis=1)
-    df['hl_color'] = np.nan
-    df['index'] = range(len(df))
-    df['hl_key'] = list(adata.obs[highlight_only]) if highlight_only is not None else 0
-    df[key] = list(map(str, adata.obs[key]))
+        if 'X_diffmap' not in ad_tmp.obsm_keys():
+            sc.tl.diffmap(ad_tmp)
+
+        # same as running `sc.tl.dpt` (with the default `n_dcs=10`) with every cell as a root:
+        # the dpt distance is the euclidean distance in the diffusion components scaled by `lambda / (1 - lambda)`,
+        # the stationary components are used as they are
+        n_dcs = 10
+        evals = ad_tmp.uns['diffmap_evals'][:n_dcs]
+        weights = np.where(evals < 0.9994, evals / (1 - np.minimum(evals, 0.9994)), 1)
+        dmat = _euclidean_dmat(ad_tmp.obsm['X_diffmap'][:, :n_dcs] * weights)
+
+        # scanpy sets the distance between different connected components to inf
+        connectivities = ad_tmp.obsp['connectivities'] if hasattr(ad_tmp, 'obsp') and 'connectivities' in ad_tmp.obsp \
+                         else ad_tmp.uns['neighbors']['connectivities']
+        n_components, components = connected_components(connectivities)
+        if n_components > 1:
+            cross = components[:, None] != components[None, :]
+            dmat[cross] = 0
+
+        # pseudotime is normalized by the furthest cell from the root in the same component
+        max_dist = np.max(dmat, axis=1, keepdims=True)
+        max_dist[max_dist == 0] = 1
+        dmat /= max_dist
+        if n_components > 1:
+            # the `inf` values are replaced by 1
+            dmat[cross] = 1
+
+    # halves the size of the data sent to the browser
+    dmat = dmat.astype(np.float32, copy=False)
+    # plain dictionary, no need to copy everything into a DataFrame
+    data = {}
+    for i, (bs, comp) in enumerate(zip(basis, components)):
+        xy = adata.obsm[f'X_{bs}'][:, comp - (bs != 'diffmap')].astype(np.float32, copy=False)
+        data[f'x{i}'], data[f'y{i}'] = xy[:, 0], xy[:, 1]
+    # j-th column contains the distances to the j-th cell,
+    # the dpt distances are not symmetric, so we need a contiguous copy
+    dmat_cols = dmat if distance != 'dpt' else np.ascontiguousarray(dmat.T)
+    for j, col in enumerate(dmat_cols):
+        data[str(j)] = col
+    data['hl_color'] = np.full(adata.n_obs, np.nan, dtype=np.float32)
+    data['index'] = np.arange(adata.n_obs, dtype=np.int32)
+    data['hl_key'] = np.asarray(adata.obs[highlight_only]) if highlight_only is not None else np.zeros(adata.n_obs, dtype=np.int32)
+    data[key] = _obs_as_str(adata, key)
 
     start_ix = '0'  # our root cell
-    ds = ColumnDataSource(df)
+    ds = ColumnDataSource(data)
     mapper = linear_cmap(field_name='hl_color', palette=palette,
-                         low=df[start_ix].min(), high=df[start_ix].max())
+                         low=float(np.min(data[start_ix])), high=float(np.max(data[start_ix])))
     static_fig_mapper = _create_mapper(adata, key)
 
     static_figs = []
@@ -1166,7 +1666,7 @@ def link_plot(adata, key, genes=None, basis=['umap', 'pca'], components=[1, 2],
 
     fig = figs[0]
 
-    end = dmat[~np.isinf(dmat)].max().max() if distance != 'dpt' else 1.0
+    end = dmat[~np.isinf(dmat)].max() if distance != 'dpt' else 1.0
     slider = Slider(start=0, end=end, value=end / 2, step=end / 1000,
                     title='Distance ' + '(dpt)' if distance == 'dpt' else f'({distance}-norm)')
     col_ds = ColumnDataSource(dict(value=[start_ix]))
@@ -1213,20 +1713,22 @@ def link_plot(adata, key, genes=None, basis=['umap', 'pca'], components=[1, 2],
         show(plot)
 
 
-def _get_mappers(adata, df, genes=[], use_raw=True, sort=True):
+def _get_mappers(adata, df, genes=[], use_raw=True, sort=True, cells=None):
     if sort:
         genes = sorted(genes)
 
-    mappers = {c:{'field': c, 'transform': _create_mapper(adata, c)}
+    mappers = {c:{'field': c, 'transform': _create_mapper(adata, c, cells=cells)}
                for c in (sorted if sort else list)(filter(lambda c: adata.obs[c].dtype.name != 'category', adata.obs.columns)) + genes}
 
+    cells = slice(None) if cells is None else cells
     # assume all columns in .obs are numbers
     for k in filter(lambda k: k not in genes, mappers.keys()):
-        df[k] = list(adata.obs[k].astype(float))
+        df[k] = adata.obs[k].values[cells].astype(float)
 
     indices, = np.where(np.in1d(adata.var_names, genes))
     for ix in indices:
-        df[adata.var_names[ix]] = (adata.raw if use_raw else adata).X[:, ix]
+        vals = (adata.raw if use_raw else adata).X[:, ix]
+        df[adata.var_names[ix]] = np.ravel(vals.A if issparse(vals) else vals)[cells]
 
     return df, mappers
 
@@ -1236,8 +1738,18 @@ def _add_color_select(key, fig, renderers, source, mappers, colors=['color', 'fi
     color_bar = ColorBar(color_mapper=mappers[key]['transform'], width=10, location=(0, 0))
     fig.add_layout(color_bar, color_bar_pos)
 
+    # every field needs an extent, the JS code reads it unconditionally
+    extents = {}
+    for field in mappers.keys():
+        vals = np.asarray(source.data[field])
+        if vals.size and np.issubdtype(vals.dtype, np.number) and not np.all(np.isnan(vals)):
+            extents[field] = [float(np.nanmin(vals)), float(np.nanmax(vals))]
+        else:
+            # e.g. a path without any nonzero counts
+            extents[field] = [0, 0]
+
     code = _inter_color_code(*colors)
-    callback= CustomJS(args=dict(renderers=renderers, source=source, color_bar=color_bar, cmaps=mappers),
+    callback= CustomJS(args=dict(renderers=renderers, source=source, color_bar=color_bar, cmaps=mappers, extents=extents),
                        code=code)
 
     return Select(title=f'Select variable to color{suffix}:', value=key,